@@ -1,3 +1,5 @@
+import argparse
+
 from utils.scraping import ejecutar_scraping
 from utils.sheets import guardar_en_hoja, conectar_google_sheets, cargar_palabras_clave
 from utils.fechas import obtener_fecha_ayer_formateada
@@ -5,6 +7,11 @@ from utils.fechas import obtener_fecha_ayer_formateada
 FORZAR_COMMIT = True
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--refresh-ids", action="store_true",
+                        help="relee los IDs desde la hoja en vez de usar la caché local")
+    args = parser.parse_args()
+
     fecha_objetivo = obtener_fecha_ayer_formateada()
     print(f"📆 Ejecutando scraping para la fecha: {fecha_objetivo}")
 
@@ -17,7 +24,7 @@ def main():
     for lic in resultados:
         print(f"{lic['id']} | {lic['titulo']} | {lic['fecha_cierre']}")
 
-    guardar_en_hoja(resultados, fecha_objetivo)
+    guardar_en_hoja(resultados, fecha_objetivo, refrescar_ids=args.refresh_ids)
 
 if __name__ == "__main__":
     main()
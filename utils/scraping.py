@@ -5,53 +5,21 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
-from oauth2client.service_account import ServiceAccountCredentials
-import gspread
 from selenium.webdriver.support import expected_conditions as EC
 from datetime import datetime
-# Si en tu main importas conectar_google_sheets desde utils.sheets,
-# esta importación siguiente puede no ser necesaria; la dejo para no perder nada.
-from utils.sheets import conectar_google_sheets
+# re-exportadas: la única implementación vive en utils/sheets.py
+from utils.sheets import conectar_google_sheets, cargar_palabras_clave
 import time
-import os
-import json
+
+__all__ = [
+    "conectar_google_sheets", "cargar_palabras_clave",
+    "iniciar_driver", "buscar_y_extraer", "ejecutar_scraping",
+]
 
 BASE_URL = "https://www.mercadopublico.cl/BuscarLicitacion"
-SPREADSHEET_ID = "1TqiNXXAgfKlSu2b_Yr9r6AdQU_WacdROsuhcHL0i6Mk"
 
 R_COMMIT = True
 
-# --- (OPCIONAL) Duplicada si ya la tienes en utils/sheets.py ---
-def conectar_google_sheets():
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
-    ]
-    # Producción: lee el JSON desde la variable de entorno
-    if "GCP_SERVICE_ACCOUNT_KEY" in os.environ:
-        creds_dict = json.loads(os.environ["GCP_SERVICE_ACCOUNT_KEY"])
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    else:
-        # Local: usa el fichero service_account.json
-        creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", scope)
-
-    client = gspread.authorize(creds)
-    print("✅ Conexión con Google Sheets exitosa")
-    return client.open_by_key(SPREADSHEET_ID)
-# --- fin duplicada ---
-
-def cargar_palabras_clave(sheet):
-    try:
-        hoja = sheet.worksheet("Palabras Clave")
-        # Lee desde la celda B9 hacia abajo
-        palabras_raw = hoja.col_values(2)[8:]  # Índice 8 porque empieza desde fila 9 (0-based)
-        palabras_clave = [p.strip() for p in palabras_raw if p.strip()]
-        print(f"🔑 {len(palabras_clave)} palabras clave cargadas desde Google Sheets.")
-        return palabras_clave
-    except Exception as e:
-        print(f"❌ Error al cargar palabras clave: {e}")
-        return []
-
 def iniciar_driver():
     options = Options()
     options.add_argument("--headless")
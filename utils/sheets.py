@@ -1,13 +1,87 @@
 import os
 import json
+import re
+import random
+import time
+from functools import lru_cache
+from string import ascii_uppercase
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from datetime import datetime
 
 SPREADSHEET_ID = "1TqiNXXAgfKlSu2b_Yr9r6AdQU_WacdROsuhcHL0i6Mk"
 
+# caché local de lo ya apilado por pestaña: {mes: {"ids", "ultimo", "filas"}}
+# en la raíz del repo (no depende del directorio desde donde se ejecute main.py)
+_IDS_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".ids_cache.json")
+_IDS_CACHE_VERSION = 1
+
+# appends en tramos: bajo el límite de 10 MB por request y la cuota de escrituras/min
+CHUNK = 5000
+RATE = 50 / 60  # escrituras por segundo
+
+# clave del scraper -> encabezado en la hoja
+COL_MAP = {
+    "fecha_extraccion":   "FyH Extracción",
+    "fecha_publicacion":  "FyH Publicación",
+    "id":                 "ID",
+    "titulo":             "Título",
+    "descripcion":        "Descripción",
+    "tipo":               "Tipo",
+    "monto":              "Monto",
+    "tipo_monto":         "Tipo Monto",
+    "link_ficha":         "LINK FICHA",
+    "fecha_visita":       "FyH TERRENO",
+    "visita_obligatoria": "OBLIG?",
+    "fecha_cierre":       "FyH CIERRE",
+}
+
+# esquema explícito: from_pylist infiere solo del primer dict y descartaría
+# claves que falten ahí; todas las columnas usadas son texto
+_SCHEMA = pa.schema([(clave, pa.string()) for clave in COL_MAP])
+
+# Columnas que se pintan verde (dato presente) o rojo (vacío / "NF")
+COLUMNAS_COLOR = ["Monto", "Tipo Monto", "FyH TERRENO", "OBLIG?"]
+VERDE = {"red": 0.72, "green": 0.88, "blue": 0.80}
+ROJO = {"red": 0.96, "green": 0.80, "blue": 0.80}
+
+def _reintentar(fn, estados, args, kwargs):
+    intentos = 6
+    for intento in range(intentos):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = e.response.status_code
+            if status not in estados or intento == intentos - 1:
+                raise
+            espera = min(60, 2 ** intento + random.random())
+            retry_after = e.response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                espera = max(espera, int(retry_after))
+            print(f"⏳ API respondió {status}, reintentando en {espera:.1f}s...")
+            time.sleep(espera)
+
+def _retry(fn, *args, **kwargs):
+    """
+    Ejecuta una LECTURA de gspread reintentando 429/500/503 con backoff
+    exponencial + jitter (respeta Retry-After si la API lo envía).
+    """
+    return _reintentar(fn, (429, 500, 503), args, kwargs)
+
+def _retry_escritura(fn, *args, **kwargs):
+    """
+    Igual que _retry pero para ESCRITURAS: solo reintenta 429 (la API no la
+    aplicó). Un 5xx puede llegar después de escribir, y reintentar duplicaría
+    filas o fallaría con "already exists".
+    """
+    return _reintentar(fn, (429,), args, kwargs)
+
+@lru_cache(maxsize=1)
 def conectar_google_sheets():
+    # autoriza y abre el Spreadsheet UNA vez por proceso (se limpia ante un 401)
     scope = [
         "https://spreadsheets.google.com/feeds",
         "https://www.googleapis.com/auth/drive"
@@ -21,13 +95,13 @@ def conectar_google_sheets():
 
     client = gspread.authorize(creds)
     print("✅ Conexión con Google Sheets exitosa")
-    return client.open_by_key(SPREADSHEET_ID)
-    
+    return _retry(client.open_by_key, SPREADSHEET_ID)
+
 
 def cargar_palabras_clave(sheet):
     try:
-        hoja = sheet.worksheet("Palabras Clave")
-        palabras_raw = hoja.col_values(6)[7:19]  # Columna F, desde fila 8 (índice 7)
+        hoja = _retry(sheet.worksheet, "Palabras Clave")
+        palabras_raw = _retry(hoja.col_values, 6)[7:19]  # Columna F, desde fila 8 (índice 7)
         palabras_clave = [p.strip() for p in palabras_raw if p.strip()]
         print(f"🔑 {len(palabras_clave)} palabras clave cargadas desde Google Sheets.")
         return palabras_clave
@@ -39,10 +113,11 @@ def cargar_palabras_clave(sheet):
 # =========================
 # Helpers robustos de hoja
 # =========================
+_NUM_RE = re.compile(r"(\d+)")
+_TRANS = str.maketrans("áéíóúñÁÉÍÓÚÑ", "aeiounAEIOUN", "°")
+
 def _norm(s: str) -> str:
-    return (s or "").strip().lower()\
-        .replace("á","a").replace("é","e").replace("í","i").replace("ó","o").replace("ú","u")\
-        .replace("ñ","n").replace("°","")
+    return (s or "").strip().lower().translate(_TRANS)
 
 def _find_header_idx(headers, candidatos):
     H = [_norm(h) for h in headers]
@@ -53,117 +128,263 @@ def _find_header_idx(headers, candidatos):
                 return i
     return None
 
-def _asegurar_encabezados(hoja, esperados):
-    headers = hoja.row_values(1)
-    if not headers:
-        hoja.update('A1', [esperados])
-        return esperados
-    # agrega faltantes al final SIN borrar los existentes
+def _asegurar_encabezados(hoja, headers, esperados):
+    # caso normal: encabezados al día, cero llamadas a la API
+    if set(esperados) <= set(headers):
+        return headers
+    # escribe SOLO las celdas faltantes a continuación de las existentes
     faltantes = [h for h in esperados if h not in headers]
-    if faltantes:
-        nuevos = headers + faltantes
-        hoja.update('A1', [nuevos])
-        return nuevos
-    return headers
-
-def _ultimo_numero(hoja, headers):
-    idx = _find_header_idx(headers, ["Número","Numero","N°","Nro","#","Num","No."])
-    if idx is None:
-        return 0
-    vals = hoja.col_values(idx+1)[1:]  # sin encabezado
-    nums = []
-    for v in vals:
-        v = (v or "").strip()
-        digits = "".join(ch for ch in v if ch.isdigit())
-        if digits:
-            try:
-                n = int(digits)
-                if n > 0: nums.append(n)
-            except:
-                pass
-    return max(nums) if nums else 0
-
-def _ids_existentes(hoja, headers):
-    idx = _find_header_idx(headers, ["ID","Id","id"])
-    if idx is None:
-        return set()
-    vals = hoja.col_values(idx+1)[1:]
-    return set((v or "").strip() for v in vals if (v or "").strip())
-
-
-def guardar_en_hoja(resultados, fecha_objetivo):
+    _retry_escritura(hoja.update, range_name=f"{_letra(len(headers))}1", values=[faltantes])
+    return headers + faltantes
+
+_CANDIDATOS_NUMERO = ["Número","Numero","N°","Nro","#","Num","No."]
+_CANDIDATOS_ID = ["ID","Id","id"]
+# números como JSON numérico (sin re-parsear dígitos en Python)
+_SIN_FORMATO = {"valueRenderOption": "UNFORMATTED_VALUE"}
+
+def _letra(idx):
+    # índice de columna 0-based -> letra A1 ("A", "B", ..., "AA")
+    if idx < 26:
+        return ascii_uppercase[idx]
+    return _letra(idx // 26 - 1) + ascii_uppercase[idx % 26]
+
+def _rango_columna(mes, idx):
+    letra = _letra(idx)
+    return f"'{mes}'!{letra}:{letra}"
+
+def _aplanar(value_range):
+    # rango de una columna -> lista de celdas (las vacías vienen como [])
+    return [fila[0] if fila else "" for fila in value_range.get("values", [])]
+
+def _leer_estado(sheet, hoja, mes, esperados):
+    """
+    Lee encabezados, columna Número y columna ID en UN solo values.batchGet
+    (asume las posiciones de `esperados`; si la hoja las tiene en otro lugar
+    hace una segunda lectura de las columnas reales).
+    """
+    idx_num, idx_id = esperados.index("Número"), esperados.index("ID")
+    rangos = [f"'{mes}'!1:1", _rango_columna(mes, idx_num), _rango_columna(mes, idx_id)]
+    resp = _retry(sheet.values_batch_get, rangos, params=_SIN_FORMATO)["valueRanges"]
+    fila1 = resp[0].get("values", [[]])
+    headers = _asegurar_encabezados(hoja, fila1[0] if fila1 else [], esperados)
+    col_num, col_id = _aplanar(resp[1]), _aplanar(resp[2])
+
+    real_num = _find_header_idx(headers, _CANDIDATOS_NUMERO)
+    real_id = _find_header_idx(headers, _CANDIDATOS_ID)
+    if real_num != idx_num or real_id != idx_id:
+        reales = [i for i in (real_num, real_id) if i is not None]
+        rangos = [_rango_columna(mes, i) for i in reales]
+        extra = _retry(sheet.values_batch_get, rangos, params=_SIN_FORMATO)["valueRanges"]
+        cols = dict(zip(reales, map(_aplanar, extra)))
+        col_num = cols.get(real_num, [])
+        col_id = cols.get(real_id, [])
+
+    return {
+        "ids": sorted(_ids_existentes(col_id[1:])),
+        "ultimo": _ultimo_numero(col_num[1:]),
+        "filas": max(len(col_num), len(col_id), 1),
+    }
+
+def _ultimo_numero(vals):
+    # con UNFORMATTED_VALUE la columna llega numérica; el regex queda solo
+    # para celdas guardadas como texto ("N°12", "12 ")
+    ultimo = max((v for v in vals if isinstance(v, (int, float)) and v > 0), default=0)
+    textos = pd.Series([v for v in vals if isinstance(v, str) and v], dtype=object)
+    nums = textos.str.extract(_NUM_RE, expand=False).dropna().astype(np.int64)
+    nums = nums[nums > 0]
+    if len(nums):
+        ultimo = max(ultimo, int(nums.max()))
+    return int(ultimo)
+
+def _ids_existentes(vals):
+    return set(filter(None, map(str.strip, map(str, vals))))
+
+
+def _cargar_cache_ids():
+    try:
+        with open(_IDS_CACHE_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if data.get("version") != _IDS_CACHE_VERSION or data.get("spreadsheet") != SPREADSHEET_ID:
+        return {}
+    return data.get("meses", {})
+
+def _cache_desfasada(sheet, mes, estado, columnas):
+    """
+    Sonda barata (un values_get de 2 filas) antes de confiar en la caché: la
+    última fila conocida debe tener datos y la siguiente estar vacía. Si no,
+    otro proceso (p. ej. el workflow diario) escribió o borró filas.
+    """
+    fila = estado["filas"]
+    rango = f"'{mes}'!A{fila}:{_letra(len(columnas) - 1)}{fila + 1}"
+    filas = _retry(sheet.values_get, rango).get("values", [])
+    return not (len(filas) == 1 and filas[0])
+
+def _guardar_cache_ids(meses):
+    data = {"version": _IDS_CACHE_VERSION, "spreadsheet": SPREADSHEET_ID, "meses": meses}
+    tmp = _IDS_CACHE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, _IDS_CACHE_PATH)  # rename atómico: nunca queda a medio escribir
+
+
+class _TokenBucket:
+    """Limitador simple: `rate` tokens por segundo, ráfaga máxima `capacidad`."""
+
+    def __init__(self, rate, capacidad=1):
+        self.rate = rate
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self.ultimo = time.monotonic()
+
+    def acquire(self):
+        while True:
+            ahora = time.monotonic()
+            self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.rate)
+            self.ultimo = ahora
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+def _instalar_formato_condicional(sheet, hoja, columnas):
+    """
+    Crea (una sola vez, al crear la pestaña) las reglas verde/rojo de
+    COLUMNAS_COLOR: verde si hay dato y no es "NF", rojo si no. Solo se
+    evalúan filas con ID, así las filas vacías no quedan en rojo.
+    """
+    id_col = _letra(columnas.index("ID"))
+    requests = []
+    for col in COLUMNAS_COLOR:
+        c = columnas.index(col)
+        x = f"TRIM({_letra(c)}2)"
+        tiene_id = f"LEN(${id_col}2)>0"
+        reglas = [
+            (f'=AND({tiene_id}, LEN({x})>0, {x}<>"NF")', VERDE),
+            (f'=AND({tiene_id}, OR(LEN({x})=0, {x}="NF"))', ROJO),
+        ]
+        for formula, color in reglas:
+            requests.append({"addConditionalFormatRule": {
+                "rule": {
+                    "ranges": [{"sheetId": hoja.id, "startRowIndex": 1,
+                                "startColumnIndex": c, "endColumnIndex": c + 1}],
+                    "booleanRule": {
+                        "condition": {"type": "CUSTOM_FORMULA",
+                                      "values": [{"userEnteredValue": formula}]},
+                        "format": {"backgroundColor": color},
+                    },
+                },
+                "index": 0,
+            }})
+    _retry_escritura(sheet.batch_update, {"requests": requests})
+
+
+def guardar_en_hoja(resultados, fecha_objetivo, refrescar_ids=False):
     """
     Apila resultados en la pestaña del mes (August, September, ...).
     - Crea encabezados si faltan.
     - Tolera 'Número'/'N°' y variantes.
-    - Deduplica por 'ID'.
-    - Evita 429 quitando formateo por-celda (solo append).
+    - Deduplica por 'ID' (usa la caché local .ids_cache.json; refrescar_ids=True
+      fuerza releer la hoja para corregir desfases).
+    - Colores de Monto/Tipo Monto/FyH TERRENO/OBLIG? por formato condicional,
+      instalado al crear la pestaña (cero llamadas de formato por append).
     """
     if not resultados:
         print("⚠️ No hay resultados para guardar.")
         return
 
     mes = datetime.strptime(fecha_objetivo, "%Y-%m-%d").strftime("%B").capitalize()
-    sheet = conectar_google_sheets()
+    try:
+        _guardar(conectar_google_sheets(), resultados, mes, refrescar_ids)
+    except gspread.exceptions.APIError as e:
+        if e.response.status_code != 401:
+            raise
+        # token vencido/revocado: reautoriza y reintenta una sola vez
+        print("🔁 Credenciales rechazadas (401), reconectando...")
+        conectar_google_sheets.cache_clear()
+        _guardar(conectar_google_sheets(), resultados, mes, refrescar_ids=True)
+
 
+def _guardar(sheet, resultados, mes, refrescar_ids):
     columnas_ordenadas = [
         "Número", "FyH Extracción", "FyH Publicación", "ID", "Título",
         "Descripción", "Tipo", "Monto", "Tipo Monto",
         "LINK FICHA", "FyH TERRENO", "OBLIG?", "FyH CIERRE"
     ]
 
-    df = pd.DataFrame(resultados)
+    # columnar vía Arrow: strings con kernels Arrow (isin/strip) en vez de objetos Python
+    df = pa.Table.from_pylist(resultados, schema=_SCHEMA).to_pandas(types_mapper=pd.ArrowDtype)
+    df = df.fillna("")  # claves ausentes/None -> "" (append_rows no acepta NA)
+    cache = _cargar_cache_ids()
+    estado = None if refrescar_ids else cache.get(mes)
 
     # abrir o crear pestaña del mes
     try:
-        hoja = sheet.worksheet(mes)
+        hoja = _retry(sheet.worksheet, mes)
     except gspread.exceptions.WorksheetNotFound:
-        hoja = sheet.add_worksheet(title=mes, rows="1000", cols="20")
-        hoja.update('A1', [columnas_ordenadas])
+        hoja = _retry_escritura(sheet.add_worksheet, title=mes, rows=str(max(5000, len(df) + 100)), cols="20")
+        _retry_escritura(hoja.update, range_name='A1', values=[columnas_ordenadas])
+        _instalar_formato_condicional(sheet, hoja, columnas_ordenadas)
+        estado = {"ids": [], "ultimo": 0, "filas": 1}
+    else:
+        if estado is not None and _cache_desfasada(sheet, mes, estado, columnas_ordenadas):
+            print("🔄 La hoja cambió desde la última corrida local, releyendo IDs...")
+            estado = None
 
-    # asegurar encabezados
-    headers = _asegurar_encabezados(hoja, columnas_ordenadas)
+    if estado is None:
+        # UNA sola lectura: encabezados, consecutivo, IDs y total de filas
+        estado = _leer_estado(sheet, hoja, mes, columnas_ordenadas)
 
-    # leer último consecutivo y IDs ya guardados (para APILAR sin duplicar)
-    ultimo = _ultimo_numero(hoja, headers)
-    ids_guardados = _ids_existentes(hoja, headers)
+    # último consecutivo y IDs ya guardados (para APILAR sin duplicar)
+    ultimo = estado["ultimo"]
+    ids_guardados = set(estado["ids"])
+    end_row = estado["filas"]
 
-    # filtrar duplicados por ID
+    # filtrar duplicados por ID (limpio una vez: lo mismo se compara y se cachea)
     if "id" in df.columns:
+        df["id"] = df["id"].str.strip()
         df = df[~df["id"].isin(ids_guardados)]
 
     if df.empty:
+        # igual se guarda el estado recién leído para no releer la hoja la próxima vez
+        cache[mes] = estado
+        _guardar_cache_ids(cache)
         print("📄 No hay nuevas licitaciones para agregar (todas ya existen en la hoja).")
         return
 
-    # mapear a columnas finales
-    df_out = pd.DataFrame()
-    df_out["Número"]           = range(ultimo + 1, ultimo + 1 + len(df))
-    df_out["FyH Extracción"]   = df.get("fecha_extraccion", "")
-    df_out["FyH Publicación"]  = df.get("fecha_publicacion", "")
-    df_out["ID"]               = df.get("id", "")
-    df_out["Título"]           = df.get("titulo", "")
-    df_out["Descripción"]      = df.get("descripcion", "")
-    df_out["Tipo"]             = df.get("tipo", "")
-    df_out["Monto"]            = df.get("monto", "")
-    df_out["Tipo Monto"]       = df.get("tipo_monto", "")
-    df_out["LINK FICHA"]       = df.get("link_ficha", "")
-    df_out["FyH TERRENO"]      = df.get("fecha_visita", "")
-    df_out["OBLIG?"]           = df.get("visita_obligatoria", "")
-    df_out["FyH CIERRE"]       = df.get("fecha_cierre", "")
-
-    # asegurar orden exacto
-    for col in columnas_ordenadas:
-        if col not in df_out.columns:
-            df_out[col] = ""
-    df_out = df_out[columnas_ordenadas]
-
-    # append (apilar)
-    hoja.append_rows(df_out.values.tolist(), value_input_option="USER_ENTERED")
-
-    # IMPORTANTE: quitamos formateo por-celda para no exceder cuotas (429).
-    # Si quieres colores automáticos, configura reglas de formato condicional manualmente
-    # o agrega una función de "aplicar_formato_condicional" que se ejecute SOLO cuando
-    # se cree la pestaña (1 batch de reglas, sin tocar cada fila).
+    # mapear a columnas finales: renombra in situ (df es local, sin copia)
+    # y reindex arma df_out en orden exacto con una sola copia
+    df.columns = [COL_MAP.get(c, c) for c in df.columns]
+    df_out = df.reindex(columns=columnas_ordenadas, fill_value="")
+    df_out["Número"] = np.arange(ultimo + 1, ultimo + 1 + len(df_out), dtype=np.int64)
+
+    # crecer la grilla una vez si no caben las filas nuevas
+    if hoja.row_count - end_row < len(df_out):
+        _retry_escritura(hoja.add_rows, len(df_out) + 500)
+
+    # append (apilar) por tramos de CHUNK filas; USER_ENTERED deja que Sheets
+    # interprete fechas y montos como antes
+    bucket = _TokenBucket(RATE)
+    for inicio in range(0, len(df_out), CHUNK):
+        parte = df_out.iloc[inicio:inicio + CHUNK]
+        bucket.acquire()
+        try:
+            _retry_escritura(hoja.append_rows, parte.values.tolist(), value_input_option="USER_ENTERED")
+        except BaseException:
+            # el tramo pudo quedar escrito (5xx, timeout, conexión cortada):
+            # se invalida la caché del mes para que la próxima corrida relea la hoja
+            cache.pop(mes, None)
+            _guardar_cache_ids(cache)
+            raise
+
+        # caché al día tras cada tramo confirmado
+        ids_guardados.update(parte["ID"].tolist())
+        estado["ids"] = sorted(ids_guardados)
+        estado["ultimo"] = ultimo + inicio + len(parte)
+        estado["filas"] = end_row + inicio + len(parte)
+        cache[mes] = estado
+        _guardar_cache_ids(cache)
 
     print(f"✅ {len(df_out)} nuevas licitaciones guardadas en la hoja '{mes}'")